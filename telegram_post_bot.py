@@ -1,11 +1,18 @@
 # telegram_post_bot.py
 
 import os
+import asyncio
+import functools
+import itertools
 import logging
 import sqlite3
-import requests
-from bs4 import BeautifulSoup
+import threading
+import httpx
+from lxml import html as lxh, etree
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from urllib.parse import urljoin
 
 from telegram import Update, InputMediaPhoto
 from telegram.constants import ParseMode
@@ -24,6 +31,7 @@ import feedparser
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
 ADMIN_CHAT_ID = int(os.getenv('ADMIN_CHAT_ID', '0'))
 RSS_FEED_URL = 'https://kuban.kp.ru/online/services/rss/'
+_BASE_URL = 'https://kuban.kp.ru/'
 
 # === Логи ===
 logging.basicConfig(
@@ -33,11 +41,117 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # === Модель Flan-T5 ===
-styler = pipeline('text2text-generation', model='google/flan-t5-small')
+MODEL_NAME = 'google/flan-t5-small'
+ONNX_DIR = os.getenv('STYLER_ONNX_DIR', 'flan-t5-small-onnx-int8')
+
+def _load_styler():
+    """Загружает стилизатор: ONNX Runtime с int8-квантованием (CPU),
+    при недоступном optimum — обычный PyTorch-пайплайн."""
+    try:
+        import onnxruntime as ort
+        from optimum.onnxruntime import ORTModelForSeq2SeqLM, ORTQuantizer
+        from optimum.onnxruntime.configuration import AutoQuantizationConfig
+        from transformers import AutoTokenizer
+
+        if not os.path.isdir(ONNX_DIR):
+            # Экспорт и квантование выполняются один раз, результат кэшируется на диске
+            model = ORTModelForSeq2SeqLM.from_pretrained(MODEL_NAME, export=True)
+            model.save_pretrained(ONNX_DIR)
+            qconfig = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+            for onnx_file in (
+                'encoder_model.onnx',
+                'decoder_model.onnx',
+                'decoder_with_past_model.onnx',
+            ):
+                quantizer = ORTQuantizer.from_pretrained(ONNX_DIR, file_name=onnx_file)
+                quantizer.quantize(save_dir=ONNX_DIR, quantization_config=qconfig)
+
+        session_options = ort.SessionOptions()
+        # Физические ядра, без гипертредов
+        session_options.intra_op_num_threads = max(1, (os.cpu_count() or 2) // 2)
+        model = ORTModelForSeq2SeqLM.from_pretrained(
+            ONNX_DIR,
+            encoder_file_name='encoder_model_quantized.onnx',
+            decoder_file_name='decoder_model_quantized.onnx',
+            decoder_with_past_file_name='decoder_with_past_model_quantized.onnx',
+            session_options=session_options,
+        )
+        tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
+        return pipeline('text2text-generation', model=model, tokenizer=tokenizer)
+    except ImportError:
+        logger.info("optimum/onnxruntime не установлены, используем PyTorch")
+    except Exception as e:
+        logger.error(f"ONNX-инициализация не удалась: {e}")
+
+    # PyTorch-фолбэк: половинная точность вдвое сокращает трафик весов
+    import torch
+    from transformers import AutoModelForSeq2SeqLM, AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
+    if torch.cuda.is_available():
+        model = AutoModelForSeq2SeqLM.from_pretrained(
+            MODEL_NAME, torch_dtype=torch.float16
+        )
+        return pipeline('text2text-generation', model=model, tokenizer=tokenizer, device=0)
+    model = AutoModelForSeq2SeqLM.from_pretrained(MODEL_NAME, torch_dtype=torch.bfloat16)
+    return pipeline('text2text-generation', model=model, tokenizer=tokenizer)
+
+# Модель грузится лениво: процесс стартует мгновенно, ~300MB подтягиваются
+# при первом обращении (или фоновым прогревом из __main__)
+_STYLER = None
+_STYLER_LOCK = threading.Lock()
+
+def _get_styler():
+    global _STYLER
+    if _STYLER is None:
+        with _STYLER_LOCK:
+            if _STYLER is None:
+                _STYLER = _load_styler()
+    return _STYLER
+
+# === Assisted decoding ===
+# Черновая модель принимает несколько токенов за один шаг основной.
+# Работает только на PyTorch-модели и при батче из одного запроса.
+DRAFT_MODEL_NAME = os.getenv('STYLER_DRAFT_MODEL', '')
+
+def _load_draft_model():
+    if not DRAFT_MODEL_NAME:
+        return None
+    try:
+        from transformers import AutoModelForSeq2SeqLM, PreTrainedModel
+        if not isinstance(_get_styler().model, PreTrainedModel):
+            logger.info("ONNX-модель не поддерживает assisted decoding")
+            return None
+        return AutoModelForSeq2SeqLM.from_pretrained(DRAFT_MODEL_NAME)
+    except Exception as e:
+        logger.error(f"Черновая модель не загрузилась: {e}")
+        return None
+
+_GENERATE_KWARGS = None
+
+def _get_generate_kwargs() -> dict:
+    global _GENERATE_KWARGS
+    if _GENERATE_KWARGS is None:
+        kwargs = {'max_new_tokens': 128}
+        draft = _load_draft_model()
+        if draft is not None:
+            kwargs['assistant_model'] = draft
+        _GENERATE_KWARGS = kwargs
+    return _GENERATE_KWARGS
 
 # === Инициализация БД ===
+# Одни и те же строки запросов -> попадание в кэш подготовленных выражений sqlite
+# OR IGNORE: повторная ссылка не падает на уникальном индексе, а молча пропускается
+_SQL_INSERT_POST = 'INSERT OR IGNORE INTO posts (chat_id, date, url) VALUES (?,?,?)'
+
 def init_db():
-    conn = sqlite3.connect('bot_data.db')
+    # check_same_thread=False: колбэки job-queue PTB могут выполняться в рабочих потоках
+    conn = sqlite3.connect('bot_data.db', check_same_thread=False)
+    # WAL + ослабленный fsync: коммит в post_article перестаёт упираться в диск
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA cache_size=-64000')
+    conn.execute('PRAGMA mmap_size=268435456')
     conn.execute('''
         CREATE TABLE IF NOT EXISTS posts (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -46,58 +160,130 @@ def init_db():
             url TEXT
         )
     ''')
+    # Старые базы могли накопить дубли url — чистим, иначе уникальный индекс не создастся
+    conn.execute(
+        'DELETE FROM posts WHERE id NOT IN (SELECT MIN(id) FROM posts GROUP BY url)'
+    )
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_posts_url ON posts(url)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_posts_date ON posts(date)')
     conn.commit()
     return conn
 
 db_conn = init_db()
 
 # === Парсинг статьи ===
-def fetch_html(url: str) -> str:
-    resp = requests.get(url)
+def _get_http(application) -> httpx.AsyncClient:
+    # Один клиент на всё приложение: keep-alive вместо нового TCP на каждый запрос
+    client = application.bot_data.get('http')
+    if client is None:
+        client = httpx.AsyncClient(
+            http2=True,
+            timeout=10,
+            follow_redirects=True,
+            limits=httpx.Limits(max_keepalive_connections=8)
+        )
+        application.bot_data['http'] = client
+    return client
+
+async def _close_http(application):
+    client = application.bot_data.pop('http', None)
+    if client is not None:
+        await client.aclose()
+
+# Кэш условных запросов: url -> (etag, text); неизменившиеся статьи отдаются как 304.
+# Небольшой LRU: повторные загрузки случаются только у свежих url
+_ETAG_CACHE: OrderedDict = OrderedDict()
+_ETAG_CACHE_SIZE = 32
+
+async def fetch_html(client: httpx.AsyncClient, url: str) -> str:
+    headers = {}
+    cached = _ETAG_CACHE.get(url)
+    if cached:
+        headers['If-None-Match'] = cached[0]
+    resp = await client.get(url, headers=headers)
+    if resp.status_code == 304 and cached:
+        _ETAG_CACHE.move_to_end(url)
+        return cached[1]
     resp.raise_for_status()
+    etag = resp.headers.get('ETag')
+    if etag:
+        _ETAG_CACHE[url] = (etag, resp.text)
+        _ETAG_CACHE.move_to_end(url)
+        while len(_ETAG_CACHE) > _ETAG_CACHE_SIZE:
+            _ETAG_CACHE.popitem(last=False)
     return resp.text
 
+# Четыре фиксированных селектора, скомпилированные один раз при импорте
+_XP_TITLE = etree.XPath("string(//h1[contains(@class, 'article__title')])")
+_XP_LEAD = etree.XPath("string(//div[contains(@class, 'article__lead')])")
+_XP_TEXT_DIV = etree.XPath("//div[contains(@class, 'article__text')][1]")
+
 def parse_article(html: str) -> dict:
-    soup = BeautifulSoup(html, 'html.parser')
-    title_tag = soup.find('h1', class_='article__title')
-    title = title_tag.get_text(strip=True) if title_tag else ''
-    lead_tag = soup.find('div', class_='article__lead')
-    lead = lead_tag.get_text(strip=True) if lead_tag else ''
-    text_div = soup.find('div', class_='article__text')
-    paragraphs = text_div.find_all('p') if text_div else []
-    text = '\n\n'.join(p.get_text(strip=True) for p in paragraphs)
+    tree = lxh.fromstring(html)
+    title = _XP_TITLE(tree).strip()
+    lead = _XP_LEAD(tree).strip()
+    text = ''
     images = []
-    if text_div:
-        for img in text_div.find_all('img', src=True):
-            src = img['src']
-            if src.startswith('//'):
-                src = 'https:' + src
-            elif src.startswith('/'):
-                src = 'https://kuban.kp.ru' + src
-            images.append(src)
+    text_divs = _XP_TEXT_DIV(tree)
+    if text_divs:
+        text_div = text_divs[0]
+        # iter() обходит поддерево без промежуточных списков узлов
+        text = '\n\n'.join(p.text_content().strip() for p in text_div.iter('p'))
+        # urljoin покрывает и '//cdn...', и '/path', и абсолютные ссылки без ветвлений
+        images = [
+            urljoin(_BASE_URL, img.get('src'))
+            for img in text_div.iter('img') if img.get('src')
+        ]
     return {'title': title, 'lead': lead, 'text': text, 'images': images}
 
 # === Стилизация текста ===
+_PROMPT_PREFIX = (
+    "Перепиши в стиле Telegram-канала КП-Кубань: лаконично, "
+    "с эмодзи, короткими абзацами. Текст: "
+)
+# ~500 токенов кириллицы — контекст Flan-T5 всё равно обрезается на 512,
+# а стоимость энкодера квадратична по длине
+_MAX_CONTENT_CHARS = 1500
+# Короче этого порога стилизация ничего не меняет — не гоняем модель
+_MIN_STYLE_CHARS = 280
+
+# Отдельный пул на один поток: инференс уходит с event loop'а, но две
+# генерации не дерутся за ядра (GIL внутри ядер PyTorch всё равно отпущен)
+_STYLE_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+
+_short_skips = 0
+
+def _count_short_skip():
+    global _short_skips
+    _short_skips += 1
+    logger.debug(f"Короткая статья, стилизация пропущена (всего: {_short_skips})")
+
+# Кэшируем результат по тексту статьи: повторная ссылка на ту же статью
+# не гоняет модель ещё раз
+@functools.lru_cache(maxsize=512)
 def generate_styled_post(content: str) -> str:
-    prompt = (
-        "Перепиши в стиле Telegram-канала КП-Кубань: лаконично, "
-        "с эмодзи, короткими абзацами. Текст: "
-        + content
-    )
+    prompt = _PROMPT_PREFIX + content[:_MAX_CONTENT_CHARS]
     # Ограничим длину ответа 128 токенами для скорости
-    result = styler(prompt, max_new_tokens=128)
+    result = _get_styler()(prompt, truncation=True, **_get_generate_kwargs())
     return result[0]['generated_text']
 
 # === Публикация статьи ===
 async def post_article(context: ContextTypes.DEFAULT_TYPE, url: str, chat_id: int):
-    html = fetch_html(url)
+    html = await fetch_html(_get_http(context.application), url)
     data = parse_article(html)
     combined = f"{data['title']}\n\n{data['lead']}\n\n{data['text']}"
-    try:
-        styled = generate_styled_post(combined)
-    except Exception as e:
-        logger.error(f"Rewriting failed: {e}")
+    if len(combined) < _MIN_STYLE_CHARS:
+        _count_short_skip()
         styled = combined
+    else:
+        try:
+            loop = asyncio.get_running_loop()
+            styled = await loop.run_in_executor(
+                _STYLE_EXECUTOR, generate_styled_post, combined
+            )
+        except Exception as e:
+            logger.error(f"Rewriting failed: {e}")
+            styled = combined
 
     # Жёстко используем переданный chat_id
     if data['images']:
@@ -105,7 +291,7 @@ async def post_article(context: ContextTypes.DEFAULT_TYPE, url: str, chat_id: in
     await context.bot.send_message(chat_id=chat_id, text=styled, parse_mode=ParseMode.HTML)
 
     db_conn.execute(
-        'INSERT INTO posts (chat_id, date, url) VALUES (?,?,?)',
+        _SQL_INSERT_POST,
         (chat_id, datetime.utcnow().isoformat(), url)
     )
     db_conn.commit()
@@ -150,14 +336,107 @@ async def digest(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(text)
 
 async def auto_announce(context: ContextTypes.DEFAULT_TYPE):
-    feed = feedparser.parse(RSS_FEED_URL)
-    for entry in feed.entries[:5]:
-        url = entry.link
-        exists = db_conn.execute(
-            'SELECT 1 FROM posts WHERE url=?', (url,)
-        ).fetchone()
-        if not exists:
-            await post_article(context, url, chat_id=ADMIN_CHAT_ID)
+    # Условный GET: для неизменившейся ленты сервер отвечает 304 без тела
+    bot_data = context.application.bot_data
+    loop = asyncio.get_running_loop()
+    # feedparser блокирует (сеть + SAX-разбор) — уводим в пул потоков
+    feed = await loop.run_in_executor(None, functools.partial(
+        feedparser.parse,
+        RSS_FEED_URL,
+        etag=bot_data.get('rss_etag'),
+        modified=bot_data.get('rss_modified')
+    ))
+    if getattr(feed, 'etag', None):
+        bot_data['rss_etag'] = feed.etag
+    if getattr(feed, 'modified', None):
+        bot_data['rss_modified'] = feed.modified
+    if getattr(feed, 'status', None) == 304:
+        # Лента не менялась — ни парсинга, ни запросов к БД
+        return
+    urls = [entry.link for entry in itertools.islice(feed.entries, 5)]
+    if not urls:
+        return
+    # Один индексный запрос вместо пяти отдельных проверок
+    placeholders = ','.join('?' * len(urls))
+    seen = {row[0] for row in db_conn.execute(
+        f'SELECT url FROM posts WHERE url IN ({placeholders})', urls
+    )}
+    new_urls = [url for url in urls if url not in seen]
+    if not new_urls:
+        return
+
+    # Скачиваем все страницы параллельно
+    client = _get_http(context.application)
+    pages = await asyncio.gather(
+        *(fetch_html(client, url) for url in new_urls),
+        return_exceptions=True
+    )
+    articles = []
+    for url, page in zip(new_urls, pages):
+        if isinstance(page, Exception):
+            logger.error(f"Fetch failed for {url}: {page}")
+            continue
+        articles.append((url, parse_article(page)))
+    if not articles:
+        return
+
+    combined_texts = [
+        f"{data['title']}\n\n{data['lead']}\n\n{data['text']}"
+        for _, data in articles
+    ]
+    # Один батчевый прогон модели вместо пяти последовательных;
+    # слишком короткие тексты публикуются как есть
+    styled_texts = list(combined_texts)
+    style_idx = [
+        i for i, text in enumerate(combined_texts) if len(text) >= _MIN_STYLE_CHARS
+    ]
+    for _ in range(len(combined_texts) - len(style_idx)):
+        _count_short_skip()
+    if style_idx:
+        prompts = [
+            _PROMPT_PREFIX + combined_texts[i][:_MAX_CONTENT_CHARS] for i in style_idx
+        ]
+        try:
+            results = await loop.run_in_executor(
+                _STYLE_EXECUTOR,
+                lambda: _get_styler()(
+                    prompts, max_new_tokens=128, batch_size=4, truncation=True
+                )
+            )
+            for i, r in zip(style_idx, results):
+                styled_texts[i] = r[0]['generated_text']
+        except Exception as e:
+            logger.error(f"Rewriting failed: {e}")
+
+    async def send_one(data: dict, styled: str):
+        if data['images']:
+            await context.bot.send_photo(chat_id=ADMIN_CHAT_ID, photo=data['images'][0])
+        await context.bot.send_message(
+            chat_id=ADMIN_CHAT_ID, text=styled, parse_mode=ParseMode.HTML
+        )
+
+    # Отправляем посты параллельно, порядок фото/текста внутри поста сохраняется;
+    # ошибка одной отправки не роняет остальные
+    send_results = await asyncio.gather(
+        *(send_one(data, styled) for (_, data), styled in zip(articles, styled_texts)),
+        return_exceptions=True
+    )
+    posted_urls = []
+    for (url, _), sent in zip(articles, send_results):
+        if isinstance(sent, Exception):
+            logger.error(f"Send failed for {url}: {sent}")
+        else:
+            posted_urls.append(url)
+    if not posted_urls:
+        return
+
+    # Записываем только доставленные посты — одной транзакцией с общей меткой времени
+    now = datetime.utcnow().isoformat()
+    db_conn.executemany(
+        _SQL_INSERT_POST,
+        [(ADMIN_CHAT_ID, now, url) for url in posted_urls]
+    )
+    db_conn.commit()
 
 async def send_report(context: ContextTypes.DEFAULT_TYPE):
     week_ago = datetime.utcnow() - timedelta(days=7)
@@ -169,7 +448,7 @@ async def send_report(context: ContextTypes.DEFAULT_TYPE):
 
 # === Точка входа ===
 if __name__ == '__main__':
-    app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+    app = ApplicationBuilder().token(TELEGRAM_TOKEN).post_shutdown(_close_http).build()
 
     # Регистрируем команды
     app.add_handler(CommandHandler('start', start))
@@ -183,5 +462,8 @@ if __name__ == '__main__':
     jq.run_repeating(auto_announce, interval=1800, first=10)
     jq.run_repeating(send_report, interval=604800, first=0)
 
+    # Прогреваем модель в фоне: первый реальный вызов не ждёт загрузки
+    threading.Thread(target=_get_styler, daemon=True).start()
+
     print("🚀 Бот запущен!")
     app.run_polling()